@@ -0,0 +1,366 @@
+"""Offline batch runner: replay scripted resident encounters without HTTP.
+
+Each line of the input JSONL is one encounter:
+
+    {"encounter_id": "r01", "case_id": "AIN",
+     "history": ["Hi, what brings you in?", "..."],
+     "history_discuss": "Top dx: ...",
+     "exam": ["Any rash?", "..."],
+     "final": "Leading dx: ...",
+     "treatment": "Stop the offending drug ...",
+     "followups": ["..."],
+     "summary": true}
+
+Omit ``case_id`` (or set it to ``"*"``) to replay the transcript against every
+case in the registry. Every key except ``encounter_id`` is optional; phases
+are run in the same order as the UI drives the API.
+
+Usage:
+    python -m app.batch encounters.jsonl -o results.jsonl -w 4 --stub-llm --no-evidence
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from app import encounter
+from app.encounter import CASES
+from app.llm import ChatLLM, StubLLM
+from app.sources import EvidenceFinder, NullEvidenceFinder
+
+# Per-process services, set by _init_worker
+_llm = None
+_sources = None
+
+
+_LIST_FIELDS = ("history", "exam", "followups")
+_TEXT_FIELDS = ("case_id", "history_discuss", "final", "treatment")
+
+
+def _validate_spec(spec, path: str, lineno: int):
+    if not isinstance(spec, dict):
+        raise ValueError(f"{path}:{lineno}: encounter must be a JSON object, got {type(spec).__name__}")
+    encounter_id = spec.get("encounter_id")
+    if not isinstance(encounter_id, str) or not encounter_id.strip():
+        raise ValueError(f"{path}:{lineno}: 'encounter_id' must be a non-empty string")
+    if "summary" in spec and not isinstance(spec["summary"], bool):
+        raise ValueError(f"{path}:{lineno}: 'summary' must be true or false")
+    for key in _LIST_FIELDS:
+        value = spec.get(key)
+        if value is not None and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            raise ValueError(f"{path}:{lineno}: '{key}' must be a list of strings")
+    for key in _TEXT_FIELDS:
+        value = spec.get(key)
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"{path}:{lineno}: '{key}' must be a string")
+    case_id = spec.get("case_id")
+    if case_id not in (None, "*") and case_id not in CASES:
+        raise ValueError(f"{path}:{lineno}: unknown case_id '{case_id}'")
+
+
+def load_encounters(path: str) -> list:
+    items = []
+    seen = {}  # encounter id -> line it came from; ids are the checkpoint key
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                spec = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{lineno}: invalid JSON ({e})") from e
+            _validate_spec(spec, path, lineno)
+            source_id = spec["encounter_id"]
+            case_id = spec.get("case_id")
+            case_ids = list(CASES.keys()) if case_id in (None, "*") else [case_id]
+            for cid in case_ids:
+                item = dict(spec, case_id=cid, source_id=source_id)
+                item["encounter_id"] = source_id if len(case_ids) == 1 else f"{source_id}:{cid}"
+                if item["encounter_id"] in seen:
+                    raise ValueError(
+                        f"{path}:{lineno}: duplicate encounter_id '{item['encounter_id']}' "
+                        f"(first seen on line {seen[item['encounter_id']]})"
+                    )
+                seen[item["encounter_id"]] = lineno
+                items.append(item)
+    return items
+
+
+def _read_results(out_path: str) -> dict:
+    """Return the last record per encounter id in ``out_path`` (in file order)."""
+    records = {}
+    if not os.path.exists(out_path):
+        return records
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # Unreadable line; _trim_partial_line keeps appends from producing these
+                continue
+            if isinstance(rec, dict) and rec.get("encounter_id") is not None:
+                records.pop(rec["encounter_id"], None)
+                records[rec["encounter_id"]] = rec
+    return records
+
+
+def load_checkpoint(out_path: str, retry_failed: bool = False) -> set:
+    """Return encounter ids that already have a record in ``out_path``.
+
+    With ``retry_failed``, only successful records count as done.
+    """
+    return {
+        encounter_id
+        for encounter_id, rec in _read_results(out_path).items()
+        if not retry_failed or rec.get("status") == "ok"
+    }
+
+
+def _trim_partial_line(out_path: str):
+    """Drop a trailing line with no newline (a record cut off by a killed run).
+
+    Otherwise the next appended record would be glued onto the fragment and
+    lost as one unreadable line. The cut-off encounter has no record, so it
+    is rerun.
+    """
+    if not os.path.exists(out_path):
+        return
+    with open(out_path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            if pos == end and chunk.endswith(b"\n"):
+                return
+            nl = chunk.rfind(b"\n")
+            if nl != -1:
+                f.truncate(pos - step + nl + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+def _compact_results(out_path: str):
+    """Rewrite ``out_path`` keeping only the last record per encounter id."""
+    records = _read_results(out_path)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for rec in records.values():
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, out_path)
+
+
+def _rag_keys(items: list) -> list:
+    keys = []
+    for item in items:
+        case_id = item["case_id"]
+        if case_id not in CASES:
+            continue
+        if item.get("history") and (case_id, "history") not in keys:
+            keys.append((case_id, "history"))
+        if item.get("exam") and (case_id, "exam") not in keys:
+            keys.append((case_id, "exam"))
+    return keys
+
+
+def _init_worker(stub_llm: bool, no_evidence: bool, rag_keys: list):
+    global _llm, _sources
+    _llm = StubLLM() if stub_llm else ChatLLM()
+    _sources = NullEvidenceFinder() if no_evidence else EvidenceFinder()
+    # Indexes are already on disk (built by the parent); this only opens the
+    # collections and loads the embedding model once per worker.
+    for case_id, phase in rag_keys:
+        encounter._get_case_rag(case_id, phase)
+
+
+def run_encounter(item: dict) -> dict:
+    started = time.perf_counter()
+    case_id = item["case_id"]
+    record = {
+        "encounter_id": item["encounter_id"],
+        "source_id": item["source_id"],
+        "case_id": case_id,
+        "status": "ok",
+        "error": None,
+    }
+    data = {}
+    turns = 0
+    try:
+        if case_id not in CASES:
+            raise ValueError(f"Unknown case_id: {case_id}")
+        data = encounter.new_session(case_id)
+
+        for msg in item.get("history") or []:
+            encounter.patient_chat(data, msg, _llm)
+            turns += 1
+        encounter.attending_open(data)
+        if item.get("history_discuss"):
+            encounter.attending_history_discuss(data, item["history_discuss"], _llm)
+            turns += 1
+        encounter.attending_exam_intro(data)
+        for msg in item.get("exam") or []:
+            encounter.attending_exam_chat(data, msg, _llm)
+            turns += 1
+        if item.get("final"):
+            encounter.attending_final_prompt(data)
+            record["final_assessment"] = encounter.attending_final_collect(data, item["final"], _llm, _sources)
+            turns += 1
+        if item.get("treatment"):
+            encounter.attending_start_treatment(data, _llm)
+            encounter.attending_treatment_assess(data, item["treatment"], _llm, _sources)
+            turns += 1
+        for msg in item.get("followups") or []:
+            encounter.attending_final_followups(data, msg, _llm)
+            turns += 1
+        if item.get("summary", True):
+            record["summary"] = encounter.attending_finalize_encounter(data, _llm)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+
+    record.update({
+        "assigned_diagnosis": CASES.get(case_id, {}).get("assigned_diagnosis"),
+        "dx_candidate": data.get("dx_candidate", ""),
+        "treatment_assessment": data.get("treatment_assessment"),
+        "stage": data.get("stage"),
+        "turns": turns,
+        "elapsed_s": round(time.perf_counter() - started, 3),
+        "chat": data.get("chat", []),
+    })
+    return record
+
+
+def _report(done: int, total: int, ok: int, turns: int, started: float, final: bool = False):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    label = "done" if final else "progress"
+    print(
+        f"[batch] {label}: {done}/{total} encounters ({ok} ok, {done - ok} failed) "
+        f"in {elapsed:.1f}s — {done / elapsed:.2f} enc/s, {turns / elapsed:.2f} turns/s",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def run_batch(in_path: str, out_path: str, workers: int = 1, stub_llm: bool = False,
+              no_evidence: bool = False, fresh: bool = False, retry_failed: bool = False,
+              log_every: int = 10) -> dict:
+    items = load_encounters(in_path)
+    if not stub_llm and not ChatLLM().use_openai:
+        raise ValueError("No LLM configured: set OPENAI_API_KEY or pass --stub-llm.")
+    if fresh and os.path.exists(out_path):
+        os.remove(out_path)
+    completed = load_checkpoint(out_path, retry_failed=retry_failed)
+    pending = [item for item in items if item["encounter_id"] not in completed]
+    skipped = len(items) - len(pending)
+    if skipped:
+        print(f"[batch] resuming: {skipped} of {len(items)} encounters already recorded",
+              file=sys.stderr, flush=True)
+
+    # Build any missing indexes once, up front, so workers never ingest concurrently.
+    rag_keys = _rag_keys(pending)
+    for case_id, phase in rag_keys:
+        encounter._get_case_rag(case_id, phase)
+
+    stats = {"total": len(items), "skipped": skipped, "pending": len(pending), "done": 0, "ok": 0, "turns": 0}
+    started = time.perf_counter()
+    initargs = (stub_llm, no_evidence, rag_keys)
+
+    executor = None
+    if workers > 1 and len(pending) > 1:
+        # spawn: Chroma/SQLite handles and torch state do not survive fork safely.
+        # A worker that dies (or an initializer that raises) surfaces as
+        # BrokenProcessPool and ends the run; records written so far are kept.
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(pending)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+        futures = [executor.submit(run_encounter, item) for item in pending]
+        results = (future.result() for future in as_completed(futures))
+    else:
+        _init_worker(*initargs)
+        results = map(run_encounter, pending)
+
+    _trim_partial_line(out_path)
+    try:
+        with open(out_path, "a", encoding="utf-8") as out:
+            for record in results:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                stats["done"] += 1
+                stats["ok"] += record["status"] == "ok"
+                stats["turns"] += record["turns"]
+                if log_every and stats["done"] % log_every == 0 and stats["done"] < stats["pending"]:
+                    _report(stats["done"], stats["pending"], stats["ok"], stats["turns"], started)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    if skipped:
+        # Retried encounters were appended; keep one row (the latest) per id.
+        _compact_results(out_path)
+    _report(stats["done"], stats["pending"], stats["ok"], stats["turns"], started, final=True)
+    stats["elapsed_s"] = round(time.perf_counter() - started, 3)
+
+    # Overall state of this input in the results file, including earlier runs
+    records = _read_results(out_path)
+    recorded = [records[item["encounter_id"]] for item in items if item["encounter_id"] in records]
+    stats["recorded"] = len(recorded)
+    stats["recorded_ok"] = sum(rec.get("status") == "ok" for rec in recorded)
+    if skipped:
+        print(
+            f"[batch] results: {stats['recorded']}/{stats['total']} encounters recorded "
+            f"({stats['recorded_ok']} ok, {stats['recorded'] - stats['recorded_ok']} failed)",
+            file=sys.stderr,
+            flush=True,
+        )
+    return stats
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay scripted resident encounters offline.")
+    parser.add_argument("encounters", help="JSONL file, one encounter per line")
+    parser.add_argument("-o", "--out", default="batch_results.jsonl", help="results JSONL (also the resume checkpoint)")
+    # Each worker loads its own embedding model and Chroma client; keep this small.
+    parser.add_argument("-w", "--workers", type=int, default=2)
+    parser.add_argument("--stub-llm", action="store_true", help="use the deterministic offline StubLLM")
+    parser.add_argument("--no-evidence", action="store_true", help="skip PubMed/web evidence lookups")
+    parser.add_argument("--fresh", action="store_true", help="discard existing results instead of resuming")
+    parser.add_argument("--retry-failed", action="store_true", help="on resume, rerun encounters recorded as failed")
+    parser.add_argument("--log-every", type=int, default=10, help="progress report interval (encounters)")
+    args = parser.parse_args(argv)
+
+    try:
+        stats = run_batch(
+            args.encounters,
+            args.out,
+            workers=args.workers,
+            stub_llm=args.stub_llm,
+            no_evidence=args.no_evidence,
+            fresh=args.fresh,
+            retry_failed=args.retry_failed,
+            log_every=args.log_every,
+        )
+    except BrokenProcessPool as e:
+        print(f"[batch] aborted: a worker process died ({e}). "
+              f"Results so far are in {args.out}; rerun to resume.", file=sys.stderr, flush=True)
+        return 1
+    except ValueError as e:
+        # Malformed encounter file or missing LLM config: no traceback
+        parser.error(str(e))
+    return 0 if stats["recorded_ok"] == stats["total"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
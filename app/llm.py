@@ -26,3 +26,15 @@ class ChatLLM:
             temperature=temperature
         )
         return resp.choices[0].message.content.strip()
+
+
+# Deterministic offline stand-in for ChatLLM (batch runs, regression, no API key)
+class StubLLM:
+    def __init__(self):
+        self.model = "stub"
+
+    def chat(self, system: str, messages: List[Dict[str,str]], temperature: float = 0.3) -> str:
+        role = (system or "").split(".")[0].strip()
+        user = [m for m in messages if m.get("role") == "user"] or messages
+        last = user[-1].get("content", "") if user else ""
+        return f"[stub] {role} | re: {last[:200]}".strip()
@@ -149,3 +149,13 @@ class EvidenceFinder:
             pass
 
         return results
+
+
+class NullEvidenceFinder:
+    """Offline stand-in for EvidenceFinder: no PubMed/web lookups, no evidence."""
+
+    def find_evidence(self, diagnosis: str, recap_text: str, max_items: int = 5) -> List[Dict[str,str]]:
+        return []
+
+    def gather_evidence(self, topic: str, max_items: int = 6) -> List[Dict]:
+        return []
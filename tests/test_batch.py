@@ -0,0 +1,193 @@
+"""Offline regression checks for app/batch.py (StubLLM + NullEvidenceFinder).
+
+Run from the repo root: python -m pytest -q
+"""
+import json
+import os
+
+import pytest
+
+# app.batch pulls in app.rag (chromadb, langchain) and app.sources (requests, bs4, Bio)
+for _module in ("dotenv", "chromadb", "langchain_community", "langchain_text_splitters",
+                "requests", "bs4", "Bio"):
+    pytest.importorskip(_module)
+
+from app import batch, encounter  # noqa: E402
+from concurrent.futures.process import BrokenProcessPool  # noqa: E402
+
+_run_encounter = batch.run_encounter
+
+
+class _FakeRAG:
+    def search(self, query, k=4):
+        if query == "boom":
+            raise RuntimeError("index unavailable")
+        return f"[1] context for {query}"
+
+
+# Module-level so spawned workers can unpickle them by reference
+def _die_on_r1(item):
+    if item["encounter_id"] == "r1":
+        os._exit(9)
+    return _run_encounter(item)
+
+
+def _failing_init(*args):
+    raise RuntimeError("cannot load embedding model")
+
+
+@pytest.fixture(autouse=True)
+def _no_index(monkeypatch):
+    # Keep the run offline and fast: no PDF ingestion or embedding model.
+    monkeypatch.setattr(encounter, "_get_case_rag", lambda case_id, phase: _FakeRAG())
+
+
+def _write_jsonl(path, lines):
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def _read_jsonl(path):
+    return [json.loads(line) for line in open(path, encoding="utf-8")]
+
+
+def _run(in_path, out_path, **kwargs):
+    return batch.run_batch(in_path, out_path, workers=1, stub_llm=True, no_evidence=True, log_every=0, **kwargs)
+
+
+def test_case_fan_out_ids(tmp_path):
+    in_path = _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": "r01", "case_id": "AIN", "history": ["hi"], "final": "AIN"}),
+        json.dumps({"encounter_id": "r02", "history": ["hello"], "exam": ["rash?"]}),
+    ])
+    out_path = str(tmp_path / "out.jsonl")
+
+    stats = _run(in_path, out_path)
+
+    ids = {rec["encounter_id"] for rec in _read_jsonl(out_path)}
+    assert ids == {"r01"} | {f"r02:{case_id}" for case_id in encounter.CASES}
+    assert "r02:AIN" in ids
+    assert stats["recorded_ok"] == stats["total"]
+
+
+def test_resume_skips_recorded_and_keeps_one_row_per_id(tmp_path):
+    in_path = _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": "r01", "case_id": "AIN", "history": ["hi"]}),
+        json.dumps({"encounter_id": "r03", "case_id": "AIN", "history": ["boom"]}),
+    ])
+    out_path = str(tmp_path / "out.jsonl")
+
+    first = _run(in_path, out_path)
+    assert first["done"] == 2
+
+    second = _run(in_path, out_path)
+    assert second["skipped"] == 2 and second["done"] == 0
+
+    third = _run(in_path, out_path, retry_failed=True)
+    assert third["skipped"] == 1 and third["done"] == 1
+
+    records = _read_jsonl(out_path)
+    assert sorted(rec["encounter_id"] for rec in records) == ["r01", "r03"]
+    assert {rec["encounter_id"]: rec["status"] for rec in records} == {"r01": "ok", "r03": "error"}
+
+
+def test_truncated_last_line_does_not_swallow_next_record(tmp_path):
+    in_path = _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": f"r{i}", "case_id": "AIN", "final": "AIN"}) for i in range(3)
+    ])
+    out_path = tmp_path / "out.jsonl"
+    _run(in_path, str(out_path))
+
+    # Simulate a run killed mid-write: r0 intact, half of r1, no r2
+    lines = out_path.read_text(encoding="utf-8").splitlines(keepends=True)
+    by_id = {json.loads(line)["encounter_id"]: line for line in lines}
+    out_path.write_text(by_id["r0"] + by_id["r1"][: len(by_id["r1"]) // 2], encoding="utf-8")
+
+    stats = _run(in_path, str(out_path))
+
+    assert stats["done"] == 2
+    assert sorted(rec["encounter_id"] for rec in _read_jsonl(out_path)) == ["r0", "r1", "r2"]
+
+
+def _pool_input(tmp_path, n=4):
+    # No history/exam, so workers never open a RAG index
+    return _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": f"r{i}", "case_id": "AIN", "final": "AIN", "treatment": "plan"})
+        for i in range(n)
+    ])
+
+
+def test_process_pool_runs_all_encounters(tmp_path):
+    in_path = _pool_input(tmp_path)
+    out_path = str(tmp_path / "out.jsonl")
+
+    stats = batch.run_batch(in_path, out_path, workers=2, stub_llm=True, no_evidence=True, log_every=0)
+
+    records = _read_jsonl(out_path)
+    assert sorted(rec["encounter_id"] for rec in records) == ["r0", "r1", "r2", "r3"]
+    assert all(rec["status"] == "ok" for rec in records)
+    assert stats["recorded_ok"] == 4
+
+
+def test_dead_worker_stops_run_and_resume_finishes(tmp_path, monkeypatch):
+    in_path = _pool_input(tmp_path)
+    out_path = str(tmp_path / "out.jsonl")
+
+    monkeypatch.setattr(batch, "run_encounter", _die_on_r1)
+    with pytest.raises(BrokenProcessPool):
+        batch.run_batch(in_path, out_path, workers=2, stub_llm=True, no_evidence=True, log_every=0)
+    assert "r1" not in {rec["encounter_id"] for rec in _read_jsonl(out_path)}
+
+    monkeypatch.setattr(batch, "run_encounter", _run_encounter)
+    batch.run_batch(in_path, out_path, workers=2, stub_llm=True, no_evidence=True, log_every=0)
+    assert sorted(rec["encounter_id"] for rec in _read_jsonl(out_path)) == ["r0", "r1", "r2", "r3"]
+
+
+def test_failing_worker_init_stops_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "_init_worker", _failing_init)
+    with pytest.raises(BrokenProcessPool):
+        batch.run_batch(_pool_input(tmp_path), str(tmp_path / "out.jsonl"),
+                        workers=2, stub_llm=True, no_evidence=True, log_every=0)
+
+
+def test_missing_llm_config_rejected_up_front(tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    out_path = tmp_path / "out.jsonl"
+    with pytest.raises(ValueError, match="No LLM configured"):
+        batch.run_batch(_pool_input(tmp_path), str(out_path), workers=1, no_evidence=True)
+    assert not out_path.exists()
+
+
+@pytest.mark.parametrize("line, message", [
+    ('["x"]', "must be a JSON object"),
+    ('{"history": ["hi"]}', "'encounter_id' must be a non-empty string"),
+    ('{"encounter_id": ["a"]}', "'encounter_id' must be a non-empty string"),
+    ('{"encounter_id": 0}', "'encounter_id' must be a non-empty string"),
+    ('{"encounter_id": "r07", "summary": "false"}', "'summary' must be true or false"),
+    ('{"encounter_id": "r08", "case_id": "nope"}', "unknown case_id 'nope'"),
+    ('{"encounter_id": "ok", "case_id": "AS"}', "duplicate encounter_id 'ok' \\(first seen on line 1\\)"),
+    ('{"encounter_id": "r04", "history": "Hi there, what brings you in?"}', "'history' must be a list of strings"),
+    ('{"encounter_id": "r05", "exam": [1, 2]}', "'exam' must be a list of strings"),
+    ('{"encounter_id": "r06", "followups": "why?"}', "'followups' must be a list of strings"),
+    ('{"encounter_id": ', "invalid JSON"),
+])
+def test_bad_input_rejected_with_location(tmp_path, line, message):
+    in_path = _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": "ok", "case_id": "AIN"}),
+        line,
+    ])
+
+    with pytest.raises(ValueError, match=message) as excinfo:
+        batch.load_encounters(in_path)
+    assert f"{in_path}:2:" in str(excinfo.value)
+
+
+def test_fan_out_id_collision_rejected(tmp_path):
+    in_path = _write_jsonl(tmp_path / "enc.jsonl", [
+        json.dumps({"encounter_id": "r02"}),
+        json.dumps({"encounter_id": "r02:AIN", "case_id": "AIN"}),
+    ])
+
+    with pytest.raises(ValueError, match="duplicate encounter_id 'r02:AIN'") as excinfo:
+        batch.load_encounters(in_path)
+    assert f"{in_path}:2:" in str(excinfo.value)